@@ -4,92 +4,259 @@ Case interview submission app with FAISS retrieval, DeepSeek feedback, and Googl
 """
 
 import streamlit as st
-import gspread
+import hashlib
+import hmac
 import json
+import os
+import queue
 import re
+import threading
+import time
 import uuid
 from datetime import datetime
-from oauth2client.service_account import ServiceAccountCredentials
 from util_functions import (
     decrypt_file,
     transcribe_audio,
     build_prompt,
     generate_feedback,
+    render_md,
     render_question_with_images
 )
-from faiss_lookup import EncryptedAnswerRetriever
-import tempfile
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+# faiss_lookup (which pulls in torch, faiss, and sentence-transformers) and
+# the Google client stack are imported lazily inside their cached loaders,
+# so first paint doesn't pay multi-second imports the details screen never
+# uses.
 
 # --- Config and Secrets ---
 DEEPSEEK_API_KEY = st.secrets["DEEPSEEK_API_KEY"]
 DECRYPTION_KEY = st.secrets["DECRYPTION_KEY"].encode()
+# Short digest used as the cache key for the loaders below, so Streamlit
+# never hashes the raw secret on cache lookups or embeds it in cache keys.
+DECRYPTION_KEY_ID = hashlib.blake2b(DECRYPTION_KEY, digest_size=8).hexdigest()
+_KEYS_BY_ID = {DECRYPTION_KEY_ID: DECRYPTION_KEY}
 DEEPGRAM_API_KEY = st.secrets["DEEPGRAM_API_KEY"]
 ENCRYPTED_PATH = "case_questions.json.encrypted"
 FAISS_INDEX_PATH = "faiss_index.encrypted"
 FAISS_META_PATH = "metadata.encrypted"
 CASE_PASSWORDS = st.secrets["CASE_PASSWORDS"]
+EMAIL_RE = re.compile(r"^[\w\.-]+@[\w\.-]+\.\w+$")
+
+# Answers shorter than this many words skip the embed + LLM pipeline.
+MIN_ANSWER_WORDS = 5
+
+WELCOME_MD = """
+### How It Works
+
+You will answer one case interview question at a time, using either voice or text.
+
+Once you've completed all questions, your responses will be reviewed by an **ex-McKinsey interview coach**.
+
+**You’ll receive personalized written feedback within 48 hours via email.**
+"""
 
 # --- Google Sheets Setup ---
-scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-creds_dict = json.loads(st.secrets["GSHEET_CREDS"])
-creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-client = gspread.authorize(creds)
-sheet = client.open_by_key(st.secrets["AnswerStorage_Sheet_ID"]).sheet1
-drive_service = build("drive", "v3", credentials=creds)
+@st.cache_resource
+def _load_google_clients():
+    """
+    Authorizes gspread and builds the Drive service once per process.
+    Cached so the three network round-trips don't repeat on every rerun.
+    """
+    import gspread
+    from googleapiclient.discovery import build
+    from oauth2client.service_account import ServiceAccountCredentials
+
+    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+    creds_dict = json.loads(st.secrets["GSHEET_CREDS"])
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+    client = gspread.authorize(creds)
+    sheet = client.open_by_key(st.secrets["AnswerStorage_Sheet_ID"]).sheet1
+    drive_service = build("drive", "v3", credentials=creds)
+    return sheet, drive_service
+
+# The flusher appends once this many rows accumulate or this much time
+# passes with rows waiting.
+FLUSH_MAX_ROWS = 5
+FLUSH_MAX_AGE_S = 5.0
+
+# --- Background Work ---
+@st.cache_resource
+def _load_executor():
+    """
+    Shared thread pool for work that shouldn't block the Submit path.
+    """
+    return ThreadPoolExecutor(max_workers=4)
+
+EXEC = _load_executor()
+
+def _drain_rows(rows):
+    """
+    Daemon loop: batches completed rows off the queue and appends them to
+    the sheet, flushing once FLUSH_MAX_ROWS accumulate or FLUSH_MAX_AGE_S
+    pass. A failed batch stays in the local buffer and is retried on the
+    next pass, so a row is only lost if the process itself dies.
+    """
+    buffer = []
+    while True:
+        try:
+            buffer.append(rows.get(timeout=FLUSH_MAX_AGE_S))
+            while len(buffer) < FLUSH_MAX_ROWS:
+                buffer.append(rows.get_nowait())
+        except queue.Empty:
+            pass
+        if buffer:
+            try:
+                sheet, _ = _load_google_clients()
+                sheet.append_rows(buffer, value_input_option="RAW")
+                for _ in buffer:
+                    rows.task_done()
+                buffer = []
+            except Exception as e:
+                print(f"[Sheets] ⚠️ append_rows failed, will retry: {e}")
+
+@st.cache_resource
+def _load_row_queue():
+    """
+    Process-level queue of completed sheet rows, drained by a daemon
+    flusher thread. Rows are queued by the feedback worker itself, so
+    persistence never depends on the user triggering another rerun —
+    a participant can close the tab right after submitting and the row
+    still lands in the sheet.
+    """
+    rows = queue.Queue()
+    threading.Thread(target=_drain_rows, args=(rows,), daemon=True, name="sheet-flusher").start()
+    return rows
+
+ROW_QUEUE = _load_row_queue()
+
+def _await_row_queue(timeout=30.0):
+    """
+    Waits for the flusher to drain every queued row; returns False if the
+    deadline passes first (e.g. the Sheets API is down and retries are
+    still going).
+    """
+    deadline = time.time() + timeout
+    while ROW_QUEUE.unfinished_tasks and time.time() < deadline:
+        time.sleep(0.2)
+    return ROW_QUEUE.unfinished_tasks == 0
+
+def _finish_submission(prompt, system_role, row):
+    """
+    Runs the DeepSeek feedback call off the main thread, slots the
+    feedback into the sheet row, and queues it for the background flusher.
+    """
+    feedback = generate_feedback(prompt, system_role, DEEPSEEK_API_KEY)
+    row.insert(8, (feedback or "").strip())
+    ROW_QUEUE.put(row)
+
+def harvest_futures(block=False):
+    """
+    Clears finished feedback futures from session state, surfacing worker
+    errors. With block=True, waits for every outstanding future. The rows
+    themselves are queued by the worker, not harvested here.
+    """
+    for key in [k for k in st.session_state if k.startswith("fut_")]:
+        fut = st.session_state[key]
+        if block or fut.done():
+            exc = fut.exception()  # blocks only when block=True
+            if exc is not None:
+                print(f"[Feedback] ⚠️ background submission failed: {exc}")
+            del st.session_state[key]
 
 # --- Session State Init ---
-def init_session_state():
-    defaults = {
+# One membership check per rerun instead of a per-key contains/setitem
+# loop. The dict literal (and its mutable values) is only built once per
+# session, so lists aren't shared between sessions.
+if "_initialized" not in st.session_state:
+    st.session_state.update({
         "submitted_questions": [],
         "current_question": 0,
         "user_name": "",
         "user_email": "",
         "details_submitted": False,
         "input_method_chosen": False,
-        "selected_input_method": None
-    }
-    for key, value in defaults.items():
-        if key not in st.session_state:
-            st.session_state[key] = value
-
-init_session_state()
+        "selected_input_method": None,
+        "_initialized": True
+    })
 
 # --- Load Data ---
-case_data = decrypt_file(ENCRYPTED_PATH, DECRYPTION_KEY)
-retriever = EncryptedAnswerRetriever(
-    encrypted_index_path=FAISS_INDEX_PATH,
-    encrypted_meta_path=FAISS_META_PATH,
-    decryption_key=DECRYPTION_KEY
-)
+@st.cache_resource
+def _load_case_data(path, mtime: float, key_id: str):
+    """
+    Decrypts the case questions file once per process instead of on every rerun.
+    Keyed on the file's mtime so deploying a new encrypted file invalidates
+    the cache without a process restart. Question id order is precomputed per
+    case so reruns can index a question directly instead of rebuilding a
+    (qid, obj) list each time.
+    """
+    data = decrypt_file(path, _KEYS_BY_ID[key_id])
+    for case in data.values():
+        case["_question_ids"] = tuple(case["questions"].keys())
+    return data
+
+@st.cache_resource
+def _load_retriever(index_path, meta_path, key_id: str):
+    """
+    Builds the encrypted FAISS retriever once per process and shares it
+    across reruns and sessions.
+    """
+    from faiss_lookup import EncryptedAnswerRetriever
+
+    return EncryptedAnswerRetriever(
+        encrypted_index_path=index_path,
+        encrypted_meta_path=meta_path,
+        decryption_key=_KEYS_BY_ID[key_id]
+    )
+
+case_data = _load_case_data(ENCRYPTED_PATH, os.path.getmtime(ENCRYPTED_PATH), DECRYPTION_KEY_ID)
+
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=512)
+def cached_nearest_neighbors(case_id, question_id, query, n=3):
+    """
+    Memoized FAISS lookup so resubmitting identical text (e.g. after an
+    error) reuses the prior k-NN result instead of re-running the search.
+    The retriever (and its torch/faiss imports) is only built on the first
+    actual lookup.
+    """
+    retriever = _load_retriever(FAISS_INDEX_PATH, FAISS_META_PATH, DECRYPTION_KEY_ID)
+    return retriever.get_nearest_neighbors(
+        query=query,
+        case_id=case_id,
+        question_id=question_id,
+        n=n
+    )
+
+@st.cache_data
+def _sorted_case_ids(ids):
+    """
+    Sorted case ids, cached per distinct id set so a redeployed case file
+    (which refreshes case_data via its mtime) also refreshes the picker.
+    """
+    return sorted(ids)
 
 # --- UI Title ---
 st.title("Case Interview Submission")
 
 # --- Welcome ---
-st.markdown("""
-### How It Works
-
-You will answer one case interview question at a time, using either voice or text.
-
-Once you've completed all questions, your responses will be reviewed by an **ex-McKinsey interview coach**.
-
-**You’ll receive personalized written feedback within 48 hours via email.**
-""")
+st.markdown(render_md(WELCOME_MD), unsafe_allow_html=True)
 
 # --- User Info ---
 if not st.session_state.details_submitted:
     st.subheader("Your Details")
-    name = st.text_input("Your name")
-    email = st.text_input("Your email address")
-    email_pattern = r"^[\w\.-]+@[\w\.-]+\.\w+$"
-
-    if st.button("Continue"):
+    # A form batches keystrokes into a single rerun on submit instead of
+    # re-executing the script on every text change.
+    with st.form("details"):
+        name = st.text_input("Your name")
+        email = st.text_input("Your email address")
+        details_submitted = st.form_submit_button("Continue")
+
+    if details_submitted:
         if not name or not email:
             st.warning("Please enter your name and email.")
             st.stop()
-        if not re.match(email_pattern, email):
+        if not EMAIL_RE.match(email):
             st.warning("Please enter a valid email address.")
             st.stop()
 
@@ -102,12 +269,15 @@ if not st.session_state.details_submitted:
 # --- Case Selection ---
 if "selected_case_id" not in st.session_state:
     st.subheader("Choose a Case")
-    case_ids = sorted(case_data.keys())
-    cols = st.columns(min(len(case_ids), 3))
+    case_ids = _sorted_case_ids(tuple(case_data.keys()))
+    # st.columns containers are tied to the current script run and cannot
+    # be cached; the layout math and sort above are.
+    n_cols = min(len(case_ids), 3)
+    cols = st.columns(n_cols)
 
     for i, cid in enumerate(case_ids):
         case_title = case_data[cid]["case_title"]
-        with cols[i % 3]:
+        with cols[i % n_cols]:
             if st.button(f"{case_title}", key=f"casebtn_{cid}"):
                 st.session_state.selected_case_id = cid
                 st.session_state.input_method_chosen = False
@@ -121,7 +291,10 @@ if f"authenticated_{case_id}" not in st.session_state:
     st.subheader("Enter Case Password")
     case_password = st.text_input("Password for this case", type="password")
     if st.button("Unlock Case"):
-        if CASE_PASSWORDS.get(case_id) == case_password:
+        # Compare as bytes: compare_digest raises TypeError on non-ASCII str.
+        if hmac.compare_digest(
+            CASE_PASSWORDS.get(case_id, "").encode(), (case_password or "").encode()
+        ):
             st.session_state[f"authenticated_{case_id}"] = True
             st.rerun()
         else:
@@ -141,20 +314,37 @@ if not st.session_state.input_method_chosen:
 
 # --- Active Case ---
 case = case_data[case_id]
-questions = list(case["questions"].items())
+question_ids = case["_question_ids"]
+
+# Clear any feedback calls that finished in the background since the
+# last rerun; their rows are already queued for the flusher.
+harvest_futures()
 
 # --- All Questions Completed ---
-if st.session_state.current_question >= len(questions):
-    st.success("You have completed all questions. Thank you!")
+if st.session_state.current_question >= len(question_ids):
+    with st.spinner("Saving your submissions..."):
+        harvest_futures(block=True)
+        saved = _await_row_queue()
+    if saved:
+        st.success("You have completed all questions. Thank you!")
+    else:
+        st.warning("Some submissions are still being saved in the background.")
     st.stop()
 
 # --- Show Case Info ---
 st.markdown(f"### Case: {case['case_title']}")
-st.markdown(case["case_text"])
+st.markdown(render_md(case["case_text"]), unsafe_allow_html=True)
 
 # --- Display Questions Incrementally ---
-for q_index in range(st.session_state.current_question + 1):
-    question_id, question_obj = questions[q_index]
+@st.fragment
+def _render_question(q_index):
+    """
+    One question's display and submission flow. As a fragment, widget
+    interactions here rerun only this block — prior questions on the page
+    aren't re-executed on every keystroke or click.
+    """
+    question_id = question_ids[q_index]
+    question_obj = case["questions"][question_id]
     st.markdown("---")
     st.markdown(f"#### Question {question_id}")
     render_question_with_images(question_obj["question_text"], image_dir="images")
@@ -163,16 +353,18 @@ for q_index in range(st.session_state.current_question + 1):
     if prev_key in st.session_state:
         st.markdown("**Your previous answer:**")
         st.markdown(f"> {st.session_state[prev_key]}")
-        continue
+        return
 
     input_method = st.session_state.selected_input_method
     user_input = ""
-    audio_bytes = None
 
     if input_method == "Text":
-        user_input = st.text_area("Your answer:", height=200, key=f"text_{case_id}_{question_id}")
-        if st.button("Submit Answer", key=f"submit_{case_id}_{question_id}"):
-            user_input = user_input.strip()
+        with st.form(f"answer_{case_id}_{question_id}"):
+            answer_text = st.text_area("Your answer:", height=200, key=f"text_{case_id}_{question_id}")
+            answer_submitted = st.form_submit_button("Submit Answer")
+
+        if answer_submitted:
+            user_input = answer_text.strip()
             if not user_input:
                 st.warning("Please enter a response before submitting.")
                 st.stop()
@@ -180,37 +372,52 @@ for q_index in range(st.session_state.current_question + 1):
     elif input_method == "Voice":
         audio_file = st.audio_input("Record your answer:", key=f"audio_{case_id}_{question_id}")
         if audio_file:
-            audio_bytes = audio_file.read()
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp_file:
-                tmp_file.write(audio_bytes)
-                temp_filepath = tmp_file.name
-
             if st.button("Submit Recording", key=f"submit_{case_id}_{question_id}"):
-                filename = f"{st.session_state.user_name}_{case_id}_{question_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.mp3"
-                with open(temp_filepath, "rb") as f:
-                    media = MediaIoBaseUpload(f, mimetype="audio/mpeg")
+                # st.audio_input records WAV; label the Drive copy to match.
+                filename = f"{st.session_state.user_name}_{case_id}_{question_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.wav"
+                audio_bytes = audio_file.getvalue()
+
+                def _upload_audio():
+                    from googleapiclient.http import MediaIoBaseUpload
+
+                    _, drive_service = _load_google_clients()
+                    media = MediaIoBaseUpload(
+                        BytesIO(audio_bytes), mimetype="audio/wav", chunksize=-1, resumable=False
+                    )
                     drive_file_metadata = {
                         "name": filename,
                         "parents": [st.secrets["DriveFolderID"]],
                     }
                     drive_service.files().create(body=drive_file_metadata, media_body=media, fields="id").execute()
 
+                # Deepgram doesn't need the Drive copy, so the upload runs in
+                # parallel with transcription: the wait is max(upload,
+                # transcribe) instead of their sum.
+                upload_fut = EXEC.submit(_upload_audio)
+
                 with st.spinner("Transcribing and submitting..."):
                     try:
                         user_input = transcribe_audio(audio_bytes, DEEPGRAM_API_KEY).strip()
                     except Exception as e:
                         st.error(f"Transcription failed: {e}")
                         st.stop()
+                    try:
+                        upload_fut.result()
+                    except Exception as e:
+                        # The transcript is what gets graded; a failed backup
+                        # upload shouldn't block the submission.
+                        st.warning(f"Audio upload to Drive failed: {e}")
 
     if user_input:
+        # Cheap gate before the embedding + DeepSeek calls: a degenerate
+        # "ok" answer shouldn't cost a model call.
+        if len(user_input.split()) < MIN_ANSWER_WORDS:
+            st.warning("Please expand your answer before submitting.")
+            st.stop()
+
         with st.spinner("Submitting answer..."):
             try:
-                examples = retriever.get_nearest_neighbors(
-                    query=user_input,
-                    case_id=case_id,
-                    question_id=question_id,
-                    n=3
-                )
+                examples = cached_nearest_neighbors(case_id, question_id, user_input, n=3)
 
                 if not examples:
                     st.info("Good work!")
@@ -223,11 +430,12 @@ for q_index in range(st.session_state.current_question + 1):
                     generation_instructions=question_obj["generation_instructions"]
                 )
 
-                feedback = generate_feedback(prompt, case["system_role"], DEEPSEEK_API_KEY)
                 timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 submission_id = str(uuid.uuid4())
 
-                sheet.append_row([
+                # The feedback column (index 8) is filled in by the worker;
+                # the user doesn't wait on the LLM call before moving on.
+                row = [
                     submission_id,
                     timestamp,
                     st.session_state.user_name,
@@ -236,15 +444,21 @@ for q_index in range(st.session_state.current_question + 1):
                     question_id,
                     user_input,
                     prompt.strip(),
-                    feedback.strip(),
                     input_method
-                ])
+                ]
+                fut = EXEC.submit(_finish_submission, prompt, case["system_role"], row)
+                st.session_state[f"fut_{submission_id}"] = fut
 
                 st.session_state[prev_key] = user_input
                 st.session_state.submitted_questions.append(question_id)
                 st.session_state.current_question += 1
                 st.success("Submitted!")
-                st.rerun()
+                # Full-app rerun: advancing current_question must redraw the
+                # question list outside this fragment.
+                st.rerun(scope="app")
 
             except Exception as e:
                 st.error(f"Submission failed: {e}")
+
+for q_index in range(st.session_state.current_question + 1):
+    _render_question(q_index)
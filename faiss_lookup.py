@@ -5,11 +5,45 @@ with fallback when no neighbors found.
 """
 
 import faiss
+import numpy as np
+import os
 import pickle
-import tempfile
+from functools import lru_cache
 from io import BytesIO
-from sentence_transformers import SentenceTransformer
-from cryptography.fernet import Fernet
+import streamlit as st
+from util_functions import decrypt_bytes
+
+class _FastembedAdapter:
+    """
+    Wraps fastembed's TextEmbedding in the encode() interface the
+    retriever expects from SentenceTransformer.
+    """
+    def __init__(self, model):
+        self.model = model
+
+    def encode(self, texts, convert_to_numpy=True):
+        return np.vstack(list(self.model.embed(texts)))
+
+@st.cache_resource
+def _get_embedder(model_name: str):
+    """
+    Loads the embedding model once per process and shares it across
+    retriever instances, so reloading retriever metadata never re-pays the
+    model load. Prefers fastembed's quantized ONNX build of the same
+    MiniLM model (int8 matmuls, no torch runtime); falls back to the
+    PyTorch sentence-transformer when fastembed isn't installed.
+    """
+    try:
+        from fastembed import TextEmbedding
+
+        qualified = model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+        return _FastembedAdapter(TextEmbedding(model_name=qualified))
+    except ImportError:
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        torch.set_num_threads(os.cpu_count() or 1)
+        return SentenceTransformer(model_name)
 
 class EncryptedAnswerRetriever:
     def __init__(self, encrypted_index_path: str, encrypted_meta_path: str, decryption_key: bytes, model_name: str = "all-MiniLM-L6-v2"):
@@ -20,47 +54,117 @@ class EncryptedAnswerRetriever:
         self._index = None
         self._metadata = None
         self._embedder = None
-        self.cipher = Fernet(self.decryption_key)
+        self._shard_ids = None
 
     @property
     def index(self):
+        """
+        Decrypts the index and deserializes it straight from memory, so the
+        plaintext never touches disk and cold start skips a write/read
+        round-trip through the filesystem.
+        """
         if self._index is None:
-            with open(self.encrypted_index_path, "rb") as f:
-                encrypted = f.read()
-                decrypted = self.cipher.decrypt(encrypted)
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".index") as tmp:
-                    tmp.write(decrypted)
-                    tmp.flush()
-                    self._index = faiss.read_index(tmp.name)
+            decrypted = decrypt_bytes(self.encrypted_index_path, self.decryption_key)
+            # Let FAISS's OpenMP kernels use every core the container has.
+            faiss.omp_set_num_threads(max(1, os.cpu_count() or 1))
+            self._index = faiss.deserialize_index(np.frombuffer(decrypted, dtype=np.uint8))
+            if hasattr(self._index, "hnsw"):
+                # Legacy hnsw layout (see rebuild_index.py). Every search
+                # here is restricted to one small shard via an IDSelector,
+                # and a filtered graph walk with a small efSearch can
+                # terminate without ever visiting an allowed node,
+                # returning -1s. Widen efSearch to the whole graph so the
+                # walk can't miss the shard; the sq8 flat layout is
+                # preferred and needs no such workaround.
+                self._index.hnsw.efSearch = max(64, self._index.ntotal)
         return self._index
 
     @property
     def metadata(self):
+        """
+        Decrypted answer metadata. Prefers msgpack (faster and no
+        code-execution surface); pickle payloads are detected by their
+        protocol marker so the shipped artifact keeps working until it is
+        re-encoded (see rebuild_index.py --metadata).
+        """
         if self._metadata is None:
-            with open(self.encrypted_meta_path, "rb") as f:
-                decrypted = self.cipher.decrypt(f.read())
+            decrypted = decrypt_bytes(self.encrypted_meta_path, self.decryption_key)
+            if decrypted[:1] == b"\x80":  # pickle protocol >= 2 marker
                 self._metadata = pickle.load(BytesIO(decrypted))
+            else:
+                import msgpack
+                self._metadata = msgpack.unpackb(decrypted, raw=False)
         return self._metadata
 
     @property
     def embedder(self):
         if self._embedder is None:
-            self._embedder = SentenceTransformer(self.model_name)
+            self._embedder = _get_embedder(self.model_name)
         return self._embedder
 
-    def get_nearest_neighbors(self, query: str, case_id: str, question_id: str, n: int = 5):
+    def _shard(self, case_id, question_id):
+        """
+        Vector ids belonging to one (case_id, question_id), built lazily
+        from the metadata so FAISS can restrict the search to that shard.
+        """
+        if self._shard_ids is None:
+            shards = {}
+            for i, meta in enumerate(self.metadata):
+                shards.setdefault((str(meta["case_id"]), str(meta["question_id"])), []).append(i)
+            self._shard_ids = {
+                key: np.asarray(ids, dtype=np.int64) for key, ids in shards.items()
+            }
+        return self._shard_ids.get((str(case_id), str(question_id)))
+
+    @lru_cache(maxsize=256)
+    def _embed_query(self, query: str):
+        """
+        Encodes a query string, memoized so resubmissions of the same text
+        skip model inference entirely. Vectors are L2-normalized: ranking is
+        unchanged for the L2 index and required for the inner-product one.
+        """
+        vec = self.embedder.encode([query], convert_to_numpy=True)
+        faiss.normalize_L2(vec)
+        return vec
+
+    def get_nearest_neighbors(self, query, case_id: str, question_id: str, n: int = 5):
         """
         Retrieve up to n similar answers for the same case_id and question_id.
-        Returns an empty list and logs a warning if none are found.
+        `query` may be a single string or a list of strings; a batch is
+        embedded and searched in one FAISS call, which amortizes the
+        per-call Python overhead across queries. The search itself is
+        restricted to the (case_id, question_id) shard via an IDSelector,
+        so FAISS never scans unrelated vectors and top-n recall within the
+        shard is guaranteed. Returns an empty list and logs a warning if
+        none are found.
         """
-        query_vec = self.embedder.encode([query], convert_to_numpy=True)
-        D, I = self.index.search(query_vec, k=20)  # overfetch
+        shard_ids = self._shard(case_id, question_id)
+        if shard_ids is None:
+            print(f"[Retriever] ⚠️ No relevant neighbors found for case_id={case_id}, question_id={question_id}")
+            return []
+
+        queries = [query] if isinstance(query, str) else list(query)
+        query_vecs = np.ascontiguousarray(
+            np.vstack([self._embed_query(q) for q in queries]), dtype=np.float32
+        )
+
+        sel = faiss.IDSelectorBatch(shard_ids)
+        if hasattr(self.index, "hnsw"):
+            params = faiss.SearchParametersHNSW(sel=sel)
+        else:
+            params = faiss.SearchParameters(sel=sel)
+        D, I = self.index.search(query_vecs, min(n, len(shard_ids)), params=params)
 
         filtered = []
-        for i in I[0]:
-            meta = self.metadata[i]
-            if str(meta["case_id"]) == str(case_id) and str(meta["question_id"]) == str(question_id):
-                filtered.append(meta)
+        seen = set()
+        for row in I:
+            for i in row:
+                if i < 0 or i in seen:
+                    continue
+                seen.add(i)
+                filtered.append(self.metadata[i])
+                if len(filtered) >= n:
+                    break
             if len(filtered) >= n:
                 break
 
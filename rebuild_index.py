@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Offline maintenance script: rebuilds the encrypted flat FAISS index as
+an inner-product index over L2-normalized vectors, so ranking matches
+cosine similarity on the cheaper dot-product kernel. Run locally with
+the deployment decryption key:
+
+    python rebuild_index.py --key <fernet-key> [--in faiss_index.encrypted] [--out faiss_index.encrypted] [--layout sq8|hnsw]
+
+The default sq8 layout stores 8-bit scalar-quantized codes instead of
+FP32 — a 4x smaller, bandwidth-friendlier index with negligible recall
+loss at d=384. It stays a flat (exhaustive) scan over the codes, which
+matters here: the app restricts every search to one small
+(case_id, question_id) shard via an IDSelector, and a flat scan over
+the shard guarantees exact top-n within it.
+
+The hnsw layout is kept for experiments but is UNSAFE with the app's
+always-on shard filtering: HNSW's graph walk has no recall guarantee
+when the selector admits only a handful of ids — it can terminate
+without visiting any allowed node and return -1s, silently dropping
+historical examples from the prompt. Only use it if the retriever
+stops filtering by shard.
+
+The vectors are carried over unchanged, so metadata ordering and ids
+are preserved and no re-embedding is needed.
+"""
+
+import argparse
+import pickle
+
+import faiss
+import msgpack
+import numpy as np
+from cryptography.fernet import Fernet
+
+# HNSW build parameters: 32 neighbors per node and a generous
+# efConstruction give >95% recall on corpora of this size.
+HNSW_M = 32
+EF_CONSTRUCTION = 200
+
+
+def _build_hnsw(vectors, d):
+    index = faiss.IndexHNSWFlat(d, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = EF_CONSTRUCTION
+    index.add(vectors)
+    return index
+
+
+def _build_sq8(vectors, d):
+    index = faiss.IndexScalarQuantizer(
+        d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+    )
+    index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def rebuild(encrypted_in: str, encrypted_out: str, key: bytes, layout: str = "sq8"):
+    cipher = Fernet(key)
+    with open(encrypted_in, "rb") as f:
+        decrypted = cipher.decrypt(f.read())
+
+    # Serialize/deserialize in memory: the plaintext index never touches
+    # disk, mirroring the runtime loader.
+    flat = faiss.deserialize_index(np.frombuffer(decrypted, dtype=np.uint8))
+
+    vectors = flat.reconstruct_n(0, flat.ntotal)
+    # MiniLM vectors are near-unit-norm; normalizing and ranking by inner
+    # product matches cosine similarity while skipping the (a-b)^2 expansion.
+    faiss.normalize_L2(vectors)
+    builder = _build_hnsw if layout == "hnsw" else _build_sq8
+    index = builder(vectors, flat.d)
+
+    rebuilt = faiss.serialize_index(index).tobytes()
+    with open(encrypted_out, "wb") as f:
+        f.write(cipher.encrypt(rebuilt))
+    print(f"Rebuilt {flat.ntotal} vectors (d={flat.d}) as {layout} -> {encrypted_out}")
+
+
+def convert_metadata(path: str, key: bytes):
+    """
+    Re-encodes the encrypted pickle metadata file as msgpack in place, so
+    the retriever loads it without pickle's code-execution surface.
+    """
+    cipher = Fernet(key)
+    with open(path, "rb") as f:
+        metadata = pickle.loads(cipher.decrypt(f.read()))
+    with open(path, "wb") as f:
+        f.write(cipher.encrypt(msgpack.packb(metadata, use_bin_type=True)))
+    print(f"Converted {len(metadata)} metadata records to msgpack -> {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the encrypted FAISS index.")
+    parser.add_argument("--key", required=True, help="Fernet decryption key")
+    parser.add_argument("--in", dest="encrypted_in", default="faiss_index.encrypted")
+    parser.add_argument("--out", dest="encrypted_out", default="faiss_index.encrypted")
+    parser.add_argument("--layout", choices=["sq8", "hnsw"], default="sq8",
+                        help="sq8: 8-bit scalar-quantized flat scan (4x smaller, exact within "
+                             "the shard filter); hnsw: graph ANN, unsafe with shard filtering")
+    parser.add_argument("--metadata", metavar="PATH",
+                        help="also convert this encrypted pickle metadata file to msgpack, in place")
+    args = parser.parse_args()
+    rebuild(args.encrypted_in, args.encrypted_out, args.key.encode(), args.layout)
+    if args.metadata:
+        convert_metadata(args.metadata, args.key.encode())
@@ -8,18 +8,62 @@ import json
 import requests
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+import markdown
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from cryptography.fernet import Fernet
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st
 
-# --- Decrypt Encrypted JSON File ---
+DEEPGRAM_URL = "https://api.deepgram.com/v1/listen"
+# Recordings shorter than this are sent in one request; longer ones are
+# split on silence and transcribed in parallel.
+CHUNK_TARGET_MS = 30_000
+SPLIT_THRESHOLD_BYTES = 2 << 20
+
+_IMG_RE = re.compile(r"(\{\{img:[^}]+\}\})")
+
+# Shared session so DeepSeek and Deepgram calls reuse pooled TLS
+# connections instead of paying a handshake per request. Deepgram is
+# known to return intermittent 408s, hence the retry with backoff.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(max_retries=Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(408, 429, 500, 502, 503, 504),
+    allowed_methods=frozenset(["POST"])
+)))
+# (connect, read) timeouts: fail fast on connect, allow slow generation.
+_TIMEOUT = (5, 60)
+
+# --- Decrypt Encrypted Files ---
+@lru_cache(maxsize=8)
+def _decrypt_cached(path, mtime, decryption_key):
+    with open(path, "rb") as f:
+        return Fernet(decryption_key).decrypt(f.read())
+
+def decrypt_bytes(encrypted_path, decryption_key):
+    """
+    Decrypts a Fernet-encrypted file and returns the plaintext bytes.
+    Memoized on (path, mtime, key) so warm workers skip the full-file
+    AES+HMAC pass; a redeployed file invalidates via its mtime.
+    """
+    return _decrypt_cached(encrypted_path, os.path.getmtime(encrypted_path), decryption_key)
+
 def decrypt_file(encrypted_path, decryption_key):
     """
-    Decrypts an encrypted JSON file using Fernet and returns parsed metadata as a dict.
+    Decrypts an encrypted JSON file using Fernet and returns parsed metadata
+    as a dict. Parses with orjson's C parser when installed.
     """
-    with open(encrypted_path, "rb") as f:
-        encrypted = f.read()
-    fernet = Fernet(decryption_key)
-    decrypted = fernet.decrypt(encrypted)
+    decrypted = decrypt_bytes(encrypted_path, decryption_key)
+    if orjson is not None:
+        return orjson.loads(decrypted)
     return json.loads(decrypted)
 
 # --- Get specific question ---
@@ -33,28 +77,22 @@ def get_question(case_data, case_id, question_id):
 def build_prompt(question_text, rubric, examples=None, user_input="", generation_instructions=""):
     """
     Builds the full prompt for the model including rubric, examples (if any), and candidate input.
+    Assembled as a list of parts joined once, so long rubrics and examples
+    don't pay repeated string reallocation on the submit path.
     """
-    retrieved_text = ""
+    parts = [
+        "\nCase Question:\n", question_text,
+        "\n\nCandidate's Answer:\n", user_input,
+        "\n\n"
+    ]
     if examples:
-        retrieved_text = "\n".join(
+        parts.append("Historical Examples:\n")
+        parts.extend(
             f"Past Answer: {item['answer']}\nFeedback Given: {item['feedback']}\n"
             for item in examples
         )
-
-    return f"""
-Case Question:
-{question_text}
-
-Candidate's Answer:
-{user_input}
-
-{"Historical Examples:\n" + retrieved_text if retrieved_text else ""}
-
-Rubric:
-{rubric}
-
-{generation_instructions}
-"""
+    parts.extend(["\n\nRubric:\n", rubric, "\n\n", generation_instructions, "\n"])
+    return "".join(parts)
 
 # --- Call DeepSeek API ---
 def generate_feedback(prompt, system_role, api_key, temperature=0.4):
@@ -76,7 +114,7 @@ def generate_feedback(prompt, system_role, api_key, temperature=0.4):
     }
 
     try:
-        response = requests.post("https://api.deepseek.com/v1/chat/completions", headers=headers, json=payload)
+        response = _SESSION.post("https://api.deepseek.com/v1/chat/completions", headers=headers, json=payload, timeout=_TIMEOUT)
         response.raise_for_status()
         return response.json()["choices"][0]["message"]["content"]
     except Exception as e:
@@ -85,34 +123,166 @@ def generate_feedback(prompt, system_role, api_key, temperature=0.4):
         return None
 
 # --- Transcribe Audio with Deepgram ---
-def transcribe_audio(audio_bytes: bytes, api_key: str) -> str:
-    response = requests.post(
-        "https://api.deepgram.com/v1/listen",
+def _audio_mimetype(audio) -> str:
+    """
+    Sniffs the container from the payload's magic bytes so the
+    Content-Type sent to Deepgram matches what we actually recorded
+    (st.audio_input produces WAV; uploads may be MP3).
+    """
+    if hasattr(audio, "seek"):
+        audio.seek(0)
+        head = audio.read(4)
+        audio.seek(0)
+    else:
+        head = bytes(audio[:4])
+    if head.startswith(b"RIFF"):
+        return "audio/wav"
+    if head.startswith(b"ID3") or head[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"):
+        return "audio/mpeg"
+    return "audio/wav"
+
+def _deepgram_request(audio, api_key: str) -> str:
+    """
+    Sends one audio payload (bytes or file-like) to Deepgram and returns
+    the transcript. File-likes are streamed in chunks by requests.
+    """
+    mimetype = _audio_mimetype(audio)
+    if hasattr(audio, "seek"):
+        audio.seek(0)
+    response = _SESSION.post(
+        DEEPGRAM_URL,
         headers={
             "Authorization": f"Token {api_key}",
-            "Content-Type": "audio/wav"
+            "Content-Type": mimetype
         },
-        data=audio_bytes
+        data=audio,
+        # Transcription reads can legitimately take minutes on long audio;
+        # a short read timeout here is the documented 408 failure mode.
+        timeout=(10, 300)
     )
     if response.status_code == 200:
         return response.json()["results"]["channels"][0]["alternatives"][0]["transcript"]
     else:
         raise RuntimeError(f"Transcription failed: {response.text}")
 
+def _audio_size(audio) -> int:
+    """
+    Returns the payload size in bytes without consuming the stream.
+    """
+    if hasattr(audio, "seek"):
+        size = audio.seek(0, 2)
+        audio.seek(0)
+        return size
+    return len(audio)
+
+def transcribe_audio(audio, api_key: str, max_workers: int = 4) -> str:
+    """
+    Transcribes audio with Deepgram. Short recordings are streamed in a
+    single request; long ones are split on silence into ~30 s chunks and
+    transcribed in parallel, so wait time stays roughly constant instead
+    of scaling with answer length. max_workers also bounds concurrent
+    Deepgram requests.
+    """
+    if _audio_size(audio) <= SPLIT_THRESHOLD_BYTES:
+        return _deepgram_request(audio, api_key)
+
+    # Only long recordings pay the pydub/ffmpeg import and decode cost.
+    from pydub import AudioSegment
+    from pydub.silence import detect_silence
+
+    audio_bytes = audio.read() if hasattr(audio, "read") else audio
+    # An explicit format keeps pydub on its native WAV reader for the
+    # st.audio_input recordings; probing would require an ffmpeg binary
+    # the deployment doesn't ship.
+    fmt = "wav" if _audio_mimetype(audio_bytes) == "audio/wav" else "mp3"
+    segment = AudioSegment.from_file(BytesIO(audio_bytes), format=fmt)
+
+    # Silence is only used to pick cut points; every millisecond of the
+    # recording ends up in exactly one chunk, so quiet speech can never be
+    # discarded. The threshold is relative to the clip's own loudness
+    # because browser recordings are often well below pydub's -16 dBFS
+    # default.
+    if segment.dBFS == float("-inf"):
+        silences = []
+    else:
+        silences = detect_silence(segment, min_silence_len=500, silence_thresh=segment.dBFS - 16)
+    cut_points = [(start + end) // 2 for start, end in silences]
+
+    chunks = []
+    chunk_start = 0
+    for cut in cut_points:
+        if cut - chunk_start >= CHUNK_TARGET_MS:
+            chunks.append(segment[chunk_start:cut])
+            chunk_start = cut
+    chunks.append(segment[chunk_start:])
+
+    # Hard-split any stretch with no usable pause so a single chunk can't
+    # grow unbounded.
+    pieces = []
+    for chunk in chunks:
+        while len(chunk) > 2 * CHUNK_TARGET_MS:
+            pieces.append(chunk[:CHUNK_TARGET_MS])
+            chunk = chunk[CHUNK_TARGET_MS:]
+        pieces.append(chunk)
+
+    buffers = []
+    for chunk in pieces:
+        buf = BytesIO()
+        chunk.export(buf, format="wav")
+        buffers.append(buf.getvalue())
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        transcripts = list(pool.map(lambda b: _deepgram_request(b, api_key), buffers))
+
+    return " ".join(t.strip() for t in transcripts if t)
+
+# --- Render Markdown as Cached HTML ---
+@st.cache_data(show_spinner=False)
+def render_md(text: str) -> str:
+    """
+    Converts markdown to HTML once per distinct text, so reruns ship
+    pre-rendered HTML instead of re-parsing the markdown each time.
+    """
+    return markdown.markdown(text, extensions=["fenced_code", "tables"])
+
 # --- Render Question with Embedded Images ---
-def render_question_with_images(text, image_dir="images"):
+@st.cache_resource
+def _image_bytes(path: str) -> bytes:
     """
-    Parses question text with {{img:filename}} placeholders and renders using Streamlit.
+    Reads an image file once per process so reruns render from memory.
     """
-    parts = re.split(r"(\{\{img:[^}]+\}\})", text)
+    with open(path, "rb") as f:
+        return f.read()
 
-    for part in parts:
+@st.cache_data(show_spinner=False)
+def _question_segments(text, image_dir):
+    """
+    Parses {{img:filename}} placeholders once per (text, image_dir) into a
+    list of (kind, payload) segments ready for rendering.
+    """
+    segments = []
+    for part in _IMG_RE.split(text):
         if part.startswith("{{img:") and part.endswith("}}"):
             img_file = part[6:-2].strip()
             img_path = os.path.join(image_dir, img_file)
             if os.path.exists(img_path):
-                st.image(img_path)
+                segments.append(("image", img_path))
             else:
-                st.warning(f"⚠️ Image not found: {img_file}")
+                segments.append(("missing", img_file))
+        else:
+            segments.append(("markdown", render_md(part)))
+    return segments
+
+def render_question_with_images(text, image_dir="images"):
+    """
+    Renders question text with {{img:filename}} placeholders using Streamlit.
+    Parsing, markdown conversion, and image reads are all cached, so reruns
+    do no disk I/O.
+    """
+    for kind, payload in _question_segments(text, image_dir):
+        if kind == "image":
+            st.image(_image_bytes(payload))
+        elif kind == "missing":
+            st.warning(f"⚠️ Image not found: {payload}")
         else:
-            st.markdown(part)
+            st.markdown(payload, unsafe_allow_html=True)